@@ -5,7 +5,7 @@ import re
 import tempfile
 from collections import defaultdict
 from datetime import datetime
-from typing import cast, Any, Dict, Iterator, List, Optional, Tuple, Union
+from typing import cast, Any, Dict, Iterator, List, Optional, Set, Tuple, Union
 
 
 RE_GITHUB_URL_MATCH = re.compile("^https://.*@?github.com/(.+)/(.+)$")
@@ -24,7 +24,7 @@ def fuzzy_list_to_dict(items: List[Tuple[str, str]]) -> Dict[str, List[str]]:
     """
     Converts list to dict preserving elements with duplicate keys
     """
-    rc: Dict[str, List[str]] = defaultdict(lambda: [])
+    rc: Dict[str, List[str]] = defaultdict(list)
     for (key, val) in items:
         rc[key].append(val)
     return dict(rc)
@@ -120,9 +120,24 @@ class GitRepo:
             print(f"+ git -C {self.repo_dir} {' '.join(args)}")
         return _check_output(["git", "-C", self.repo_dir] + list(args))
 
+    def _run_git_stream(self, *args: Any) -> Iterator[str]:
+        """
+        Yields output of git command line by line, without buffering all of it in memory
+        """
+        from subprocess import Popen, PIPE
+        if self.debug:
+            print(f"+ git -C {self.repo_dir} {' '.join(args)}")
+        cmd = ["git", "-C", self.repo_dir] + list(args)
+        with Popen(cmd, stdout=PIPE, stderr=PIPE) as proc:
+            assert proc.stdout is not None and proc.stderr is not None
+            for line in proc.stdout:
+                yield line.decode("utf-8").rstrip("\n")
+            stderr = proc.stderr.read().decode("utf-8")
+        if proc.returncode != 0:
+            raise RuntimeError(f"Command `{' '.join(cmd)}` returned non-zero exit code {proc.returncode}\n```\n{stderr}```")
+
     def revlist(self, revision_range: str) -> List[str]:
-        rc = self._run_git("rev-list", revision_range, "--", ".").strip()
-        return rc.split("\n") if len(rc) > 0 else []
+        return [line for line in self._run_git_stream("rev-list", revision_range, "--", ".") if len(line) > 0]
 
     def current_branch(self) -> str:
         return self._run_git("symbolic-ref", "--short", "HEAD").strip()
@@ -140,7 +155,7 @@ class GitRepo:
 
     def show_ref(self, name: str) -> str:
         refs = self._run_git('show-ref', '-s', name).strip().split('\n')
-        if not all(refs[i] == refs[0] for i in range(1, len(refs))):
+        if len(set(refs)) > 1:
             raise RuntimeError(f"referce {name} is ambigous")
         return refs[0]
 
@@ -151,13 +166,30 @@ class GitRepo:
         return self._run_git('merge-base', from_ref, to_ref).strip()
 
     def patch_id(self, ref: Union[str, List[str]]) -> List[Tuple[str, str]]:
-        is_list = isinstance(ref, list)
-        if is_list:
-            if len(ref) == 0:
-                return []
-            ref = " ".join(ref)
-        rc = _check_output(['sh', '-c', f'git -C {self.repo_dir} show {ref}|git patch-id --stable']).strip()
-        return [cast(Tuple[str, str], x.split(" ", 1)) for x in rc.split("\n")]
+        refs = ref if isinstance(ref, list) else [ref]
+        if len(refs) == 0:
+            return []
+        from subprocess import Popen, PIPE
+        # Stream refs to a single `git log` process over stdin rather than command line,
+        # which keeps one fork+exec for arbitrary number of commits
+        log_cmd = ["git", "-C", self.repo_dir, "log", "--no-walk=unsorted", "--stdin", "-p"]
+        patch_id_cmd = ["git", "patch-id", "--stable"]
+        if self.debug:
+            print(f"+ {' '.join(log_cmd)} | {' '.join(patch_id_cmd)}")
+        # Refs are passed via file rather than pipe, so that writing them can not block on unread patch-ids
+        with tempfile.TemporaryFile() as refs_file:
+            refs_file.write(("\n".join(refs) + "\n").encode("utf-8"))
+            refs_file.seek(0)
+            with Popen(log_cmd, stdin=refs_file, stdout=PIPE) as log_proc:
+                assert log_proc.stdout is not None
+                with Popen(patch_id_cmd, stdin=log_proc.stdout, stdout=PIPE) as patch_id_proc:
+                    # Only patch-id should hold the read end of the pipe
+                    log_proc.stdout.close()
+                    rc = patch_id_proc.communicate()[0].decode("utf-8").strip()
+        for (cmd, proc) in [(log_cmd, log_proc), (patch_id_cmd, patch_id_proc)]:
+            if proc.returncode != 0:
+                raise RuntimeError(f"Command `{' '.join(cmd)}` returned non-zero exit code {proc.returncode}")
+        return [cast(Tuple[str, str], x.split(" ", 1)) for x in rc.split("\n")] if len(rc) > 0 else []
 
     def commits_resolving_gh_pr(self, pr_num: int) -> List[str]:
         owner, name = self.gh_owner_and_name()
@@ -179,13 +211,27 @@ class GitRepo:
         Returns list of commmits that are missing in each other branch since their merge base
         Might be slow if merge base is between two branches is pretty far off
         """
-        from_ref = self.rev_parse(from_branch)
-        to_ref = self.rev_parse(to_branch)
-        merge_base = self.get_merge_base(from_ref, to_ref)
-        from_commits = self.revlist(f'{merge_base}..{from_ref}')
-        to_commits = self.revlist(f'{merge_base}..{to_ref}')
-        from_ids = fuzzy_list_to_dict(self.patch_id(from_commits))
-        to_ids = fuzzy_list_to_dict(self.patch_id(to_commits))
+        # Symmetric difference lists commits of both branches since merge base in one git invocation
+        from_commits: List[str] = []
+        to_commits: List[str] = []
+        for line in self._run_git_stream('rev-list', '--left-right', f'{from_branch}...{to_branch}', '--', '.'):
+            if line.startswith("<"):
+                from_commits.append(line[1:])
+            elif line.startswith(">"):
+                to_commits.append(line[1:])
+        # Compute patch-ids for both branches in one pass
+        from_commits_set = set(from_commits)
+        from_patch_ids: List[Tuple[str, str]] = []
+        to_patch_ids: List[Tuple[str, str]] = []
+        for (patch_id, commit) in self.patch_id(from_commits + to_commits):
+            if commit in from_commits_set:
+                from_patch_ids.append((patch_id, commit))
+            else:
+                to_patch_ids.append((patch_id, commit))
+        from_ids = fuzzy_list_to_dict(from_patch_ids)
+        to_ids = fuzzy_list_to_dict(to_patch_ids)
+        from_drop: Set[str] = set()
+        to_drop: Set[str] = set()
         for patch_id in set(from_ids).intersection(set(to_ids)):
             from_values = from_ids[patch_id]
             to_values = to_ids[patch_id]
@@ -207,27 +253,29 @@ class GitRepo:
                                                     "7106d216c29ca16a3504aa2bedad948ebcf4abc2"}
                         ):
                             raise RuntimeError(f"Unexpected differences between {frc} and {toc}")
-                    from_commits.remove(frc.commit_hash)
-                    to_commits.remove(toc.commit_hash)
+                    from_drop.add(frc.commit_hash)
+                    to_drop.add(toc.commit_hash)
                 continue
-            for commit in from_values:
-                from_commits.remove(commit)
-            for commit in to_values:
-                to_commits.remove(commit)
+            from_drop.update(from_values)
+            to_drop.update(to_values)
         # Another HACK: Patch-id is not stable for commits with binary files or for big changes across commits
         # I.e. cherry-picking those from one branch into another will change patchid
         if "pytorch/pytorch" in self.remote_url():
-            for excluded_commit in {"8e09e20c1dafcdbdb45c2d1574da68a32e54a3a5",
-                                    "5f37e5c2a39c3acb776756a17730b865f0953432",
-                                    "b5222584e6d6990c6585981a936defd1af14c0ba",
-                                    "84d9a2e42d5ed30ec3b8b4140c38dd83abbce88d",
-                                    "f211ec90a6cdc8a2a5795478b5b5c8d7d7896f7e"}:
-                if excluded_commit in from_commits:
-                    from_commits.remove(excluded_commit)
-
+            from_drop.update({"8e09e20c1dafcdbdb45c2d1574da68a32e54a3a5",
+                              "5f37e5c2a39c3acb776756a17730b865f0953432",
+                              "b5222584e6d6990c6585981a936defd1af14c0ba",
+                              "84d9a2e42d5ed30ec3b8b4140c38dd83abbce88d",
+                              "f211ec90a6cdc8a2a5795478b5b5c8d7d7896f7e"})
+        # Rebuild lists in a single pass rather than calling O(n) `list.remove` for every match
+        from_commits = [commit for commit in from_commits if commit not in from_drop]
+        to_commits = [commit for commit in to_commits if commit not in to_drop]
         return (from_commits, to_commits)
 
     def cherry_pick_commits(self, from_branch: str, to_branch: str) -> None:
+        # Fastpath: nothing to cherry-pick if from_branch is an ancestor of to_branch
+        if self.rev_parse(from_branch) == self.get_merge_base(from_branch, to_branch):
+            print("Nothing to do")
+            return
         orig_branch = self.current_branch()
         self.checkout(to_branch)
         from_commits, to_commits = self.compute_branch_diffs(from_branch, to_branch)
@@ -270,6 +318,15 @@ class GitRepo:
     def commit_message(self, ref: str) -> str:
         return self._run_git("log", "-1", "--format=%B", ref)
 
+    def commit_messages(self, revision_range: str) -> Dict[str, str]:
+        """
+        Returns messages of all commits in the range keyed by commit hash
+        Equivalent to calling `commit_message` for each commit, but runs git only once
+        """
+        # Use control characters, which are unlikely to appear in commit messages, as separators
+        rc = self._run_git("log", "--format=%H%x01%B%n%x02", revision_range)
+        return dict(cast(Tuple[str, str], record.lstrip("\n").split("\x01", 1)) for record in rc.split("\x02")[:-1])
+
     def amend_commit_message(self, msg: str) -> None:
         self._run_git("commit", "--amend", "-m", msg)
 
@@ -1,20 +1,29 @@
 #!/usr/bin/env python3
 
 import base64
+import io
 import json
 import os
+import random
 import re
+import threading
 import time
 import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from dataclasses import dataclass
-from urllib.request import urlopen, Request
+from http.client import HTTPResponse, HTTPSConnection
 from urllib.error import HTTPError
 from typing import Iterable, cast, Any, Callable, Dict, List, Optional, Tuple, Union
 from gitutils import get_git_remote_name, get_git_repo_dir, patterns_to_regex, GitRepo
 from functools import lru_cache
 from warnings import warn
 
+try:
+    import orjson
+except ImportError:
+    orjson = None  # type: ignore[assignment]
+
 
 GH_PR_REVIEWS_FRAGMENT = """
 fragment PRReviews on PullRequestReviewConnection {
@@ -87,77 +96,83 @@ fragment CommitAuthors on PullRequestCommitConnection {
 }
 """
 
-GH_GET_PR_INFO_QUERY = GH_PR_REVIEWS_FRAGMENT + GH_CHECKSUITES_FRAGMENT + GH_COMMIT_AUTHORS_FRAGMENT + """
-query ($owner: String!, $name: String!, $number: Int!) {
-  repository(owner: $owner, name: $name) {
-    pullRequest(number: $number) {
-      closed
-      isCrossRepository
-      author {
-        login
-      }
-      title
-      body
-      headRefName
-      headRepository {
-        nameWithOwner
-      }
-      baseRefName
-      baseRepository {
-        nameWithOwner
-        isPrivate
-        defaultBranchRef {
-          name
+GH_PR_INFO_FRAGMENT = GH_PR_REVIEWS_FRAGMENT + GH_CHECKSUITES_FRAGMENT + GH_COMMIT_AUTHORS_FRAGMENT + """
+fragment PRInfo on PullRequest {
+  closed
+  isCrossRepository
+  author {
+    login
+  }
+  title
+  body
+  headRefName
+  headRepository {
+    nameWithOwner
+  }
+  baseRefName
+  baseRepository {
+    nameWithOwner
+    isPrivate
+    defaultBranchRef {
+      name
+    }
+  }
+  mergeCommit {
+    oid
+  }
+  commits_with_authors:commits(first: 100) {
+    ...CommitAuthors
+    totalCount
+  }
+  commits(last: 1) {
+    nodes {
+      commit {
+        checkSuites(first: 10) {
+          ...PRCheckSuites
         }
-      }
-      mergeCommit {
+        pushedDate
         oid
       }
-      commits_with_authors:commits(first: 100) {
-        ...CommitAuthors
-        totalCount
-      }
-      commits(last: 1) {
-        nodes {
-          commit {
-            checkSuites(first: 10) {
-              ...PRCheckSuites
-            }
-            pushedDate
-            oid
-          }
-        }
-      }
-      changedFiles
-      files(first: 100) {
-        nodes {
-          path
-        }
-        pageInfo {
-          endCursor
-          hasNextPage
-        }
-      }
-      reviews(last: 100) {
-       ...PRReviews
+    }
+  }
+  changedFiles
+  files(first: 100) {
+    nodes {
+      path
+    }
+    pageInfo {
+      endCursor
+      hasNextPage
+    }
+  }
+  reviews(last: 100) {
+   ...PRReviews
+  }
+  comments(last: 5) {
+    nodes {
+      bodyText
+      author {
+        login
       }
-      comments(last: 5) {
-        nodes {
-          bodyText
-          author {
-            login
-          }
-          authorAssociation
-          editor {
-            login
-          }
-          databaseId
-        }
-        pageInfo {
-          startCursor
-          hasPreviousPage
-        }
+      authorAssociation
+      editor {
+        login
       }
+      databaseId
+    }
+    pageInfo {
+      startCursor
+      hasPreviousPage
+    }
+  }
+}
+"""
+
+GH_GET_PR_INFO_QUERY = GH_PR_INFO_FRAGMENT + """
+query ($owner: String!, $name: String!, $number: Int!) {
+  repository(owner: $owner, name: $name) {
+    pullRequest(number: $number) {
+      ...PRInfo
     }
   }
 }
@@ -310,40 +325,108 @@ RE_PULL_REQUEST_RESOLVED = re.compile(
 )
 RE_DIFF_REV = re.compile(r'^Differential Revision:.+?(D[0-9]+)', re.MULTILINE)
 
+def _json_dumps(obj: Any) -> bytes:
+    return orjson.dumps(obj) if orjson is not None else json.dumps(obj).encode()
+
+
+def _json_load(fp: Any) -> Any:
+    return orjson.loads(fp.read()) if orjson is not None else json.load(fp)
+
+
+# Keep-alive connections keyed by host, which saves TCP and TLS handshakes on consecutive API calls
+# Kept per thread, as http.client connections are not thread-safe
+_https_connections = threading.local()
+
+
+def _https_request(url: str,
+                   headers: Dict[str, str],
+                   data: Optional[bytes],
+                   method: str) -> Tuple[HTTPResponse, bytes]:
+    parsed = urllib.parse.urlsplit(url)
+    assert parsed.scheme == "https", f"Unsupported url {url}"
+    path = urllib.parse.urlunsplit(("", "", parsed.path, parsed.query, ""))
+    pool: Dict[str, HTTPSConnection] = _https_connections.__dict__.setdefault("pool", {})
+
+    def send(conn: HTTPSConnection) -> Tuple[HTTPResponse, bytes]:
+        try:
+            conn.request(method, path, body=data, headers=headers)
+            resp = conn.getresponse()
+            return resp, resp.read()
+        except Exception:
+            conn.close()
+            pool.pop(parsed.netloc, None)
+            raise
+
+    conn = pool.get(parsed.netloc)
+    if conn is not None:
+        try:
+            return send(conn)
+        except ConnectionError:
+            # Server could have dropped idle connection, retry with a new one
+            pass
+    conn = pool[parsed.netloc] = HTTPSConnection(parsed.netloc)
+    return send(conn)
+
+
 def _fetch_url(url: str, *,
                headers: Optional[Dict[str, str]] = None,
-               data: Optional[Dict[str, Any]] = None,
+               data: Optional[Union[Dict[str, Any], bytes]] = None,
                method: Optional[str] = None,
-               reader: Callable[[Any], Any] = lambda x: x.read()) -> Any:
+               reader: Callable[[Any], Any] = lambda x: x.read(),
+               max_attempts: int = 5) -> Any:
     if headers is None:
         headers = {}
     token = os.environ.get("GITHUB_TOKEN")
     if token is not None and url.startswith('https://api.github.com/'):
         headers['Authorization'] = f'token {token}'
-    data_ = json.dumps(data).encode() if data is not None else None
-    try:
-        with urlopen(Request(url, headers=headers, data=data_, method=method)) as conn:
-            return reader(conn)
-    except HTTPError as err:
-        if err.code == 403 and all(key in err.headers for key in ['X-RateLimit-Limit', 'X-RateLimit-Used']):
-            print(f"Rate limit exceeded: {err.headers['X-RateLimit-Used']}/{err.headers['X-RateLimit-Limit']}")
-        raise
+    # GitHub API rejects requests without User-Agent
+    headers.setdefault('User-Agent', 'pytorch-trymerge')
+    data_ = data if data is None or isinstance(data, bytes) else _json_dumps(data)
+    if data_ is not None:
+        headers.setdefault('Content-Type', 'application/json')
+    # GraphQL requests made by this script are read-only queries, so those are as safe to resend as GET ones
+    idempotent = data is None or url == "https://api.github.com/graphql"
+    for attempt in range(max_attempts):
+        try:
+            resp, body = _https_request(url, headers, data_, method if method is not None else ("POST" if data_ is not None else "GET"))
+            if resp.status in [301, 302, 307, 308] and resp.getheader('Location') is not None:
+                # Do not leak token if redirected outside of GitHub API
+                headers = {k: v for k, v in headers.items() if k != 'Authorization'}
+                return _fetch_url(cast(str, resp.getheader('Location')), headers=headers, data=data, method=method, reader=reader)
+            if resp.status >= 400:
+                raise HTTPError(url, resp.status, resp.reason, resp.headers, io.BytesIO(body))
+            return reader(io.BytesIO(body))
+        except HTTPError as err:
+            delay = None
+            if err.code == 403 and all(key in err.headers for key in ['X-RateLimit-Limit', 'X-RateLimit-Used']):
+                print(f"Rate limit exceeded: {err.headers['X-RateLimit-Used']}/{err.headers['X-RateLimit-Limit']}")
+                if err.headers.get('X-RateLimit-Remaining') == '0' and err.headers.get('X-RateLimit-Reset') is not None:
+                    delay = int(err.headers['X-RateLimit-Reset']) - time.time()
+            if err.code in [403, 429] and err.headers.get('Retry-After') is not None:
+                delay = int(err.headers['Retry-After'])
+            elif err.code >= 500 and idempotent:
+                delay = 2 ** attempt + random.random()
+            if delay is None or attempt + 1 == max_attempts:
+                raise
+            delay = min(max(delay, 0), 60)
+            print(f"Request to {url} failed with {err.code}, retrying in {delay:.1f} sec")
+            time.sleep(delay)
 
 def fetch_json(url: str,
                params: Optional[Dict[str, Any]] = None,
                data: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
     headers = {'Accept': 'application/vnd.github.v3+json'}
     if params is not None and len(params) > 0:
-        url += '?' + '&'.join(f"{name}={urllib.parse.quote(str(val))}" for name, val in params.items())
-    return cast(List[Dict[str, Any]], _fetch_url(url, headers=headers, data=data, reader=json.load))
+        url += '?' + urllib.parse.urlencode(params, doseq=True, quote_via=urllib.parse.quote)
+    return cast(List[Dict[str, Any]], _fetch_url(url, headers=headers, data=data, reader=_json_load))
 
 def fetch_json_dict(url: str,
                     params: Optional[Dict[str, Any]] = None,
                     data: Optional[Dict[str, Any]] = None) -> Dict[str, Any] :
     headers = {'Accept': 'application/vnd.github.v3+json'}
     if params is not None and len(params) > 0:
-        url += '?' + '&'.join(f"{name}={urllib.parse.quote(str(val))}" for name, val in params.items())
-    return cast(Dict[str, Any], _fetch_url(url, headers=headers, data=data, reader=json.load))
+        url += '?' + urllib.parse.urlencode(params, doseq=True, quote_via=urllib.parse.quote)
+    return cast(Dict[str, Any], _fetch_url(url, headers=headers, data=data, reader=_json_load))
 
 def _gh_post_comment(url: str, comment: str, dry_run: bool = False) -> List[Dict[str, Any]]:
     if dry_run:
@@ -365,16 +448,52 @@ def gh_add_labels(org: str, project: str, pr_num: int, labels: Union[str, List[s
                data={"labels": labels})
 
 
+@lru_cache(maxsize=None)
+def _gh_graphql_payload_prefix(query: str) -> bytes:
+    """ Returns JSON-encoded beginning of GraphQL request, with query whitespace collapsed """
+    return b'{"query":' + _json_dumps(re.sub(r"\s+", " ", query).strip()) + b',"variables":'
+
+
 def gh_graphql(query: str, **kwargs: Any) -> Dict[str, Any]:
-    rc = _fetch_url("https://api.github.com/graphql", data={"query": query, "variables": kwargs}, reader=json.load)
+    data = _gh_graphql_payload_prefix(query) + _json_dumps(kwargs) + b'}'
+    rc = _fetch_url("https://api.github.com/graphql", data=data, reader=_json_load)
     if "errors" in rc:
         raise RuntimeError(f"GraphQL query {query}, args {kwargs} failed: {rc['errors']}")
     return cast(Dict[str, Any], rc)
 
 
+# Open PRs must be refetched on every merge attempt to pick up new reviews and checks,
+# but closed ones (i.e. already landed parts of ghstack) can be reused
+_closed_pr_info: Dict[Tuple[str, str, int], Any] = {}
+
+
 def gh_get_pr_info(org: str, proj: str, pr_no: int) -> Any:
+    key = (org, proj, pr_no)
+    if key in _closed_pr_info:
+        return _closed_pr_info[key]
     rc = gh_graphql(GH_GET_PR_INFO_QUERY, name=proj, owner=org, number=pr_no)
-    return rc["data"]["repository"]["pullRequest"]
+    info = rc["data"]["repository"]["pullRequest"]
+    if info["closed"]:
+        _closed_pr_info[key] = info
+    return info
+
+
+def gh_get_prs_info(org: str, proj: str, pr_nos: List[int]) -> Dict[int, Any]:
+    """ Fetches info for several PRs at once, using aliased pullRequest queries in one GraphQL request """
+    rc = {pr_no: _closed_pr_info[(org, proj, pr_no)] for pr_no in pr_nos if (org, proj, pr_no) in _closed_pr_info}
+    pr_nos = [pr_no for pr_no in dict.fromkeys(pr_nos) if pr_no not in rc]
+    if len(pr_nos) == 0:
+        return rc
+    query = GH_PR_INFO_FRAGMENT + "query ($owner: String!, $name: String!) {\n  repository(owner: $owner, name: $name) {\n"
+    query += "".join(f"    pr{pr_no}: pullRequest(number: {pr_no}) {{\n      ...PRInfo\n    }}\n" for pr_no in pr_nos)
+    query += "  }\n}\n"
+    repository = gh_graphql(query, name=proj, owner=org)["data"]["repository"]
+    for pr_no in pr_nos:
+        info = repository[f"pr{pr_no}"]
+        if info["closed"]:
+            _closed_pr_info[(org, proj, pr_no)] = info
+        rc[pr_no] = info
+    return rc
 
 
 @lru_cache(maxsize=None)
@@ -425,12 +544,12 @@ class GitHubComment:
 
 
 class GitHubPR:
-    def __init__(self, org: str, project: str, pr_num: int) -> None:
+    def __init__(self, org: str, project: str, pr_num: int, info: Optional[Any] = None) -> None:
         assert isinstance(pr_num, int)
         self.org = org
         self.project = project
         self.pr_num = pr_num
-        self.info = gh_get_pr_info(org, project, pr_num)
+        self.info = gh_get_pr_info(org, project, pr_num) if info is None else info
         self.changed_files: Optional[List[str]] = None
         self.conclusions: Optional[Dict[str, Tuple[str, str]]] = None
         self.comments: Optional[List[GitHubComment]] = None
@@ -470,10 +589,10 @@ class GitHubPR:
     def get_changed_files(self) -> List[str]:
         if self.changed_files is None:
             info = self.info
-            self.changed_files = []
+            changed_files: List[str] = []
             # Do not try to fetch more than 10K files
             for _ in range(100):
-                self.changed_files += [x["path"] for x in info["files"]["nodes"]]
+                changed_files += [x["path"] for x in info["files"]["nodes"]]
                 if not info["files"]["pageInfo"]["hasNextPage"]:
                     break
                 rc = gh_graphql(GH_GET_PR_NEXT_FILES_QUERY,
@@ -482,18 +601,17 @@ class GitHubPR:
                                 number=self.pr_num,
                                 cursor=info["files"]["pageInfo"]["endCursor"])
                 info = rc["data"]["repository"]["pullRequest"]
-
-        if len(self.changed_files) != self.get_changed_files_count():
-            raise RuntimeError("Changed file count mismatch")
+            if len(changed_files) != self.get_changed_files_count():
+                raise RuntimeError("Changed file count mismatch")
+            self.changed_files = changed_files
         return self.changed_files
 
     def _get_reviews(self) -> List[Tuple[str, str]]:
         if self._reviews is None:
-            self._reviews = []
+            pages: List[Any] = []
             info = self.info
             for _ in range(100):
-                nodes = info["reviews"]["nodes"]
-                self._reviews = [(node["author"]["login"], node["state"]) for node in nodes] + self._reviews
+                pages.append(info["reviews"]["nodes"])
                 if not info["reviews"]["pageInfo"]["hasPreviousPage"]:
                     break
                 rc = gh_graphql(GH_GET_PR_PREV_REVIEWS_QUERY,
@@ -502,11 +620,14 @@ class GitHubPR:
                                 number=self.pr_num,
                                 cursor=info["reviews"]["pageInfo"]["startCursor"])
                 info = rc["data"]["repository"]["pullRequest"]
-        reviews = {}
-        for (author, state) in self._reviews:
-            if state != "COMMENTED":
-                reviews[author] = state
-        return list(reviews.items())
+            # Pages are fetched from newest to oldest, keep only the latest non-comment review of each author
+            reviews: Dict[str, str] = {}
+            for nodes in reversed(pages):
+                for node in nodes:
+                    if node["state"] != "COMMENTED":
+                        reviews[node["author"]["login"]] = node["state"]
+            self._reviews = list(reviews.items())
+        return self._reviews
 
     def get_approved_by(self) -> List[str]:
         return [login for (login, state) in self._get_reviews() if state == "APPROVED"]
@@ -606,16 +727,14 @@ class GitHubPR:
         return conclusions
 
     def get_authors(self) -> Dict[str, str]:
-        rc = {}
         # TODO: replace with  `self.get_commit_count()` when GraphQL pagination can be used
         # to fetch all commits, see https://gist.github.com/malfet/4f35321b0c9315bcd7116c7b54d83372
         # and https://support.github.com/ticket/enterprise/1642/1659119
-        if self.get_commit_count() <= 250:
-            assert len(self._fetch_authors()) == self.get_commit_count()
-        for idx in range(len(self._fetch_authors())):
-            rc[self.get_committer_login(idx)] = self.get_committer_author(idx)
-
-        return rc
+        authors = self._fetch_authors()
+        commit_count = self.get_commit_count()
+        if commit_count <= 250:
+            assert len(authors) == commit_count
+        return dict(authors)
 
     def get_author(self) -> str:
         authors = self.get_authors()
@@ -700,27 +819,37 @@ class GitHubPR:
 
     def merge_ghstack_into(self, repo: GitRepo, force: bool, comment_id: Optional[int] = None) -> None:
         assert self.is_ghstack_pr()
-        approved_by = self.get_approved_by()
         # For ghstack, cherry-pick commits based from origin
         orig_ref = f"{repo.remote}/{re.sub(r'/head$', '/orig', self.head_ref())}"
         rev_list = repo.revlist(f"{self.default_branch()}..{orig_ref}")
-        for idx, rev in enumerate(reversed(rev_list)):
-            msg = repo.commit_message(rev)
+        msgs = repo.commit_messages(f"{self.default_branch()}..{orig_ref}")
+        # Resolve PR numbers of the whole stack first to fetch their info in a single request
+        stack: List[Tuple[str, int]] = []
+        for rev in reversed(rev_list):
+            msg = msgs[rev]
             m = RE_PULL_REQUEST_RESOLVED.search(msg)
             if m is None:
                 raise RuntimeError(f"Could not find PR-resolved string in {msg} of ghstacked PR {self.pr_num}")
             if self.org != m.group('owner') or self.project != m.group('repo'):
                 raise RuntimeError(f"PR {m.group('number')} resolved to wrong owner/repo pair")
-            pr_num = int(m.group('number'))
-            commit_msg = self.gen_commit_message(filter_ghstack=True)
+            stack.append((rev, int(m.group('number'))))
+        prs_info = gh_get_prs_info(self.org, self.project, [pr_num for (_, pr_num) in stack if pr_num != self.pr_num])
+        prs = {pr_num: GitHubPR(self.org, self.project, pr_num, info=info) for (pr_num, info) in prs_info.items()}
+        skip_internal_checks = can_skip_internal_checks(self, comment_id)
+        # Checking merge rules is dominated by GitHub API latency, so do it for all open PRs in the stack concurrently
+        # Raises exception for the first PR in the stack for which matching rule is not found
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(lambda pr: find_matching_merge_rule(pr, repo, force=force, skip_internal_checks=skip_internal_checks),
+                              [prs[pr_num] for (_, pr_num) in stack if pr_num in prs and not prs[pr_num].is_closed()]))
+        self_commit_msg = self.gen_commit_message(filter_ghstack=True)
+        for idx, (rev, pr_num) in enumerate(stack):
+            commit_msg = self_commit_msg
             if pr_num != self.pr_num:
-                pr = GitHubPR(self.org, self.project, pr_num)
+                pr = prs[pr_num]
                 if pr.is_closed():
                     print(f"Skipping {idx+1} of {len(rev_list)} PR (#{pr_num}) as its already been merged")
                     continue
                 commit_msg = pr.gen_commit_message(filter_ghstack=True)
-                # Raises exception if matching rule is not found
-                find_matching_merge_rule(pr, repo, force=force, skip_internal_checks=can_skip_internal_checks(self, comment_id))
 
             repo.cherry_pick(rev)
             repo.amend_commit_message(commit_msg)
@@ -732,7 +861,7 @@ class GitHubPR:
         # Adding the url here makes it clickable within the Github UI
         approved_by_urls = ', '.join(prefix_with_github_url(login) for login in self.get_approved_by())
         msg = self.get_title() + f" (#{self.pr_num})\n\n"
-        msg += self.get_body() if not filter_ghstack else re.sub(RE_GHSTACK_DESC, "", self.get_body())
+        msg += self.get_body() if not filter_ghstack else RE_GHSTACK_DESC.sub("", self.get_body())
         msg += f"\nPull Request resolved: {self.get_pr_url()}\n"
         msg += f"Approved by: {approved_by_urls}\n"
         return msg
@@ -806,7 +935,7 @@ def read_merge_rules(repo: Optional[GitRepo], org: str, project: str) -> List[Me
         json_data = _fetch_url(
             f"https://api.github.com/repos/{org}/{project}/contents/{repo_relative_rules_path}",
             headers={'Accept': 'application/vnd.github.v3+json'},
-            reader=json.load,
+            reader=_json_load,
         )
         content = base64.b64decode(json_data["content"])
         return cast(List[MergeRule], json.loads(content, object_hook=lambda x: MergeRule(**x)))
@@ -947,7 +1076,7 @@ def try_revert(repo: GitRepo, pr: GitHubPR, *,
     repo.checkout(pr.default_branch())
     repo.revert(commit_sha)
     msg = repo.commit_message("HEAD")
-    msg = re.sub(RE_PULL_REQUEST_RESOLVED, "", msg)
+    msg = RE_PULL_REQUEST_RESOLVED.sub("", msg)
     msg += revert_msg
     repo.amend_commit_message(msg)
     repo.push(pr.default_branch(), dry_run)